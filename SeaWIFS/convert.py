@@ -12,21 +12,36 @@ where there is no data.
 
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import cftime
 import numpy as np
 import requests
 import xarray as xr
 from ilamb3 import dataset as il
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
+
+# a single session shared across the download threads reuses pooled
+# connections and TLS sessions
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.5),
+    ),
+)
 
 
-def download_file(remote_source: str):
+def download_file(remote_source: str, position: int = 0):
     """Download the source and show a progress bar."""
     local_source = os.path.basename(remote_source)
     local_source = local_source.split("?")[0]
     if not os.path.isfile(local_source):
-        resp = requests.get(remote_source, stream=True)
+        resp = SESSION.get(remote_source, stream=True)
         total_size = int(resp.headers.get("content-length"))
         with open(local_source, "wb") as fdl:
             with tqdm(
@@ -35,8 +50,10 @@ def download_file(remote_source: str):
                 unit_scale=True,
                 desc=local_source,
                 ascii=True,
+                mininterval=0.25,
+                position=position,
             ) as pbar:
-                for chunk in resp.iter_content(chunk_size=1024):
+                for chunk in resp.iter_content(chunk_size=1 << 20):
                     if chunk:
                         fdl.write(chunk)
                         pbar.update(len(chunk))
@@ -58,8 +75,15 @@ remote_sources = [
     "SEASTAR_SEAWIFS_GAC.19971101_20101130.L3m.MC.CHL.chlor_a.9km.nc",
     "SEASTAR_SEAWIFS_GAC.19971201_20101231.L3m.MC.CHL.chlor_a.9km.nc",
 ]
-for source in remote_sources:
-    download_file(f"{PREFIX}{source}?appkey={EARTHDATA_APPKEY}")
+# the files are independent so download them concurrently
+with ThreadPoolExecutor(max_workers=8) as executor:
+    list(
+        executor.map(
+            download_file,
+            [f"{PREFIX}{source}?appkey={EARTHDATA_APPKEY}" for source in remote_sources],
+            range(len(remote_sources)),
+        )
+    )
 download_stamp = time.strftime(
     "%Y-%m-%d", time.localtime(os.path.getmtime(remote_sources[0]))
 )
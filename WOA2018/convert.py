@@ -2,32 +2,60 @@
 """
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from typing import Tuple, Union
 
 import cftime as cf
 import requests
 import xarray as xr
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# a single session shared across the download threads reuses pooled
+# connections and TLS sessions
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.5),
+    ),
+)
 
 
 def download_files(
     remote_sources: Union[str, list[str]], output_path: str = "_raw"
 ) -> Tuple[Union[str, list], str, str]:
     """Given a string or list of strings representing remote files, download the
-    files if they are not already present."""
+    files if they are not already present. The files are independent so they
+    are fetched concurrently; sequential fetches leave the wall time dominated
+    by per-file latency."""
     if isinstance(remote_sources, str):
         remote_sources = [remote_sources]
-    local_sources = []
-    for remote_source in remote_sources:
-        local_source = os.path.join(output_path, os.path.basename(remote_source))
-        local_sources.append(local_source)
-        if not os.path.isfile(local_source):
-            print(f"Downloading {remote_source}...")
-            with requests.get(remote_source) as req:
-                with open(local_source, "wb") as out:
-                    out.write(req.content)
-        download_stamp = time.strftime(
-            "%Y-%m-%d", time.localtime(os.path.getmtime(local_source))
-        )
+    local_sources = [
+        os.path.join(output_path, os.path.basename(remote_source))
+        for remote_source in remote_sources
+    ]
+
+    def _fetch_one(remote_source: str, local_source: str):
+        if os.path.isfile(local_source):
+            return
+        print(f"Downloading {remote_source}...")
+        # stream to disk so peak memory stays at the chunk size rather than
+        # the full file
+        with SESSION.get(remote_source, stream=True) as req:
+            with open(local_source, "wb") as out:
+                for chunk in req.iter_content(chunk_size=1 << 20):
+                    out.write(chunk)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(_fetch_one, remote_sources, local_sources))
+    # stamp with the newest file so partial re-downloads are reflected
+    download_stamp = time.strftime(
+        "%Y-%m-%d",
+        time.localtime(max(os.path.getmtime(p) for p in local_sources)),
+    )
     generate_stamp = time.strftime("%Y-%m-%d")
     if len(local_sources) == 1:
         local_sources = local_sources[0]
@@ -53,11 +81,23 @@ variable_name = {
     "n": "no3",
 }
 
-# Loop through each WOA variable, check for the presence of the data, and
-# re-encode bring up to CF standards
-if not os.path.isdir("_raw"):
-    os.makedirs("_raw")
-for var, name in noaa_name.items():
+# the monthly time axis and its bounds are identical for every variable so
+# build the cftime objects once outside the loop
+TIMES = [cf.DatetimeNoLeap(2000, m, 15) for m in range(1, 13)]
+TIME_BNDS = xr.DataArray(
+    [
+        [
+            cf.DatetimeNoLeap(2000, m + 1, 1),
+            cf.DatetimeNoLeap(2000 + (m == 11), (m + 1) % 12 + 1, 1),
+        ]
+        for m in range(12)
+    ],
+    dims=["time", "nbounds"],
+)
+
+def convert_var(var: str, name: str) -> None:
+    """Download a WOA variable, check for the presence of the data, and
+    re-encode bring up to CF standards."""
     remote = []
     TAG = "all" if var in ["n", "i", "o", "p"] else "95A4"
     for month in range(1, 13):
@@ -68,13 +108,39 @@ for var, name in noaa_name.items():
     local, download_time, generate_time = download_files(remote)
 
     # WOA files have encoded 'time' in a way that is not compatible with
-    # xarray's read
-    dset = [xr.open_dataset(ds, decode_times=False) for ds in local]
-    dset = sorted(dset, key=lambda ds: ds["time"])
-    dset = xr.concat(dset, dim="time")
-    dset = dset.assign_coords(
-        {"time": [cf.DatetimeNoLeap(2000, m, 15) for m in range(1, 13)]}
+    # xarray's read. Skip the unused statistics variables at open time rather
+    # than dropping them after the concat, and open lazily so the concat does
+    # not materialize the months.
+    drop = ["crs", "climatology_bounds"] + [
+        f"{var}_{postfix}"
+        for postfix in [
+            "dd",
+            "mn",
+            "sd",
+            "se",
+            "oa",
+            "ma",
+            "gp",
+        ]
+    ]
+    def _preprocess(d):
+        # rename on each monthly file before the concat so the combined
+        # dataset never needs rebuilding just for the rename
+        return d.rename({f"{var}_an": variable_name[var]})
+
+    # The filenames encode the month as 01..12 so a string sort gives time
+    # order without eagerly reading every file's time variable.
+    dset = xr.open_mfdataset(
+        sorted(local),
+        combine="nested",
+        concat_dim="time",
+        decode_times=False,
+        parallel=True,
+        drop_variables=drop,
+        preprocess=_preprocess,
+        chunks={"time": 1},
     )
+    dset = dset.assign_coords({"time": TIMES})
 
     # inadvertently added a time dimension to bounds
     dset["lat_bnds"] = dset["lat_bnds"].isel({"time": 0})
@@ -82,34 +148,7 @@ for var, name in noaa_name.items():
     dset["depth_bnds"] = dset["depth_bnds"].isel({"time": 0})
 
     # add time bounds
-    dset["time_bnds"] = xr.DataArray(
-        [
-            [
-                cf.DatetimeNoLeap(2000, m + 1, 1),
-                cf.DatetimeNoLeap(2000 + (m == 11), (m + 1) % 12 + 1, 1),
-            ]
-            for m in range(12)
-        ],
-        dims=["time", "nbounds"],
-    )
-
-    # Drop some of these variables and rename for output
-    dset = dset.drop(
-        ["crs", "climatology_bounds"]
-        + [
-            f"{var}_{postfix}"
-            for postfix in [
-                "dd",
-                "mn",
-                "sd",
-                "se",
-                "oa",
-                "ma",
-                "gp",
-            ]
-        ]
-    )
-    dset = dset.rename({f"{var}_an": variable_name[var]})
+    dset["time_bnds"] = TIME_BNDS.copy()
 
     # correct the units
     units = dset[variable_name[var]].attrs["units"]
@@ -134,10 +173,32 @@ for var, name in noaa_name.items():
     }
     """,
     }
+    # compress the 4-D field and chunk it by month, matching how ILAMB reads
+    # the data back
     dset.to_netcdf(
         f"{variable_name[var]}.nc",
         encoding={
+            variable_name[var]: {
+                "zlib": True,
+                "complevel": 4,
+                "shuffle": True,
+                "chunksizes": (
+                    1,
+                    dset.sizes["depth"],
+                    dset.sizes["lat"],
+                    dset.sizes["lon"],
+                ),
+            },
             "time": {"units": "days since 1850-01-01", "bounds": "time_bnds"},
             "time_bnds": {"units": "days since 1850-01-01"},
         },
     )
+
+
+# the six variables share no state so convert them in parallel; processes
+# rather than threads so the netCDF4/HDF5 lock does not serialize them
+if __name__ == "__main__":
+    if not os.path.isdir("_raw"):
+        os.makedirs("_raw")
+    with ProcessPoolExecutor(max_workers=min(6, os.cpu_count())) as executor:
+        list(executor.map(convert_var, noaa_name.keys(), noaa_name.values()))
@@ -1,11 +1,64 @@
 """."""
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
-import matplotlib.pyplot as plt
+import matplotlib
 import numpy as np
+
+# the output is PNG only, so render with Agg and skip any GUI backend import
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
 from ILAMB.Variable import Variable
 from mpl_toolkits.axes_grid1.inset_locator import inset_axes
 
+# numba is optional; when present the pairwise bias sample is collected by a
+# fused parallel kernel instead of broadcasting masked arrays
+try:
+    from numba import njit, prange
+
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+if HAS_NUMBA:
+
+    @njit(parallel=True, cache=True)
+    def _pair_abs_diffs(values, mask, iu, ju, out, counts):
+        """Collect |a - b| over the unmasked cells of every source pair,
+        fusing the subtract, abs, and compress into one parallel pass."""
+        size = values.shape[1]
+        for p in prange(iu.size):
+            a = values[iu[p]]
+            b = values[ju[p]]
+            ma = mask[iu[p]]
+            mb = mask[ju[p]]
+            c = 0
+            for k in range(size):
+                if not (ma[k] or mb[k]):
+                    out[p, c] = abs(a[k] - b[k])
+                    c += 1
+            counts[p] = c
+
+
+# construct the map features once; cartopy caches the parsed shapefile
+# geometries on the instance so every axes reuses them
+_LAND_110M = cfeature.NaturalEarthFeature(
+    "physical", "land", "110m", edgecolor="face", facecolor="0.875"
+)
+_OCEAN_110M = cfeature.NaturalEarthFeature(
+    "physical", "ocean", "110m", edgecolor="face", facecolor="0.750"
+)
+
+
+def _percentile(values, q):
+    """Pick percentiles by partial selection, avoiding the full sort that
+    np.percentile performs on these large compressed grids."""
+    idx = (np.atleast_1d(q) / 100.0 * (values.size - 1)).astype(int)
+    out = np.partition(values, idx)[idx]
+    return out[0] if np.isscalar(q) else out
+
 
 def CreateVariableComparisonArray(data, cmap, name, filename, ncolors=7):
     # initialization stuff
@@ -15,125 +68,139 @@ def CreateVariableComparisonArray(data, cmap, name, filename, ncolors=7):
     n = len(data)
 
     # interpolate all variables to a composed grid
-    lat = None
-    lon = None
-    for i in range(n):
-        if lat is None:
-            lat = data[sources[i]].lat
-            lon = data[sources[i]].lon
-        else:
-            lat = np.hstack([lat, data[sources[i]].lat])
-            lon = np.hstack([lon, data[sources[i]].lon])
-    lat = np.unique(lat)
-    lon = np.unique(lon)
+    lat = np.unique(np.concatenate([data[s].lat for s in sources]))
+    lon = np.unique(np.concatenate([data[s].lon for s in sources]))
     for i in range(n):
-        data[sources[i]] = data[sources[i]].interpolate(lat=lat, lon=lon)
+        src = data[sources[i]]
+        # sources already on the composed grid need no interpolation pass
+        if np.array_equal(src.lat, lat) and np.array_equal(src.lon, lon):
+            continue
+        data[sources[i]] = src.interpolate(lat=lat, lon=lon)
 
-    # find limits of the difference
-    bias = None
-    for i in range(n):
-        for j in range(n):
-            if i < j:
-                a = data[sources[i]]
-                b = data[sources[j]]
-                if bias is None:
-                    bias = np.abs(a.data - b.data).compressed()
-                else:
-                    bias = np.hstack([bias, np.abs(a.data - b.data).compressed()])
-    bias = np.percentile(bias, 98)
-
-    # find limits of the mean
-    values = None
-    for key in data:
-        if values is None:
-            values = data[key].data.compressed()
-        else:
-            values = np.hstack([values, data[key].data.compressed()])
-    limits = np.percentile(values, [2, 98])
+    # masked-array ufuncs are far slower than plain ndarray ones, so demote
+    # any source whose mask turns out to be empty after interpolation; float32
+    # is ample for plotting and halves the bytes every pass below moves
+    for source in sources:
+        d = data[source].data
+        if d.mask is np.ma.nomask or not d.mask.any():
+            d = np.asarray(d)
+        data[source].data = d.astype(np.float32, copy=False)
+    # bind the variables once; the n-squared plotting loop below need not
+    # re-hash the data dict on every panel
+    arrs = [data[s] for s in sources]
+
+    # find limits of the difference, stacking the interpolated grids once and
+    # differencing every i<j pair through the upper-triangle indices rather
+    # than a python pair loop of growing hstacks
+    arr = np.ma.stack([v.data for v in arrs], axis=0)
+    iu, ju = np.triu_indices(n, k=1)
+    pairs = {}
+    if HAS_NUMBA:
+        values = np.ascontiguousarray(np.ma.getdata(arr).reshape(n, -1))
+        mask2d = np.ascontiguousarray(np.ma.getmaskarray(arr).reshape(n, -1))
+        out = np.empty((iu.size, values.shape[1]), dtype=values.dtype)
+        counts = np.empty(iu.size, dtype=np.int64)
+        _pair_abs_diffs(values, mask2d, iu, ju, out, counts)
+        sample = np.concatenate([out[p, : counts[p]] for p in range(iu.size)])
+    else:
+        diffs = arr[iu] - arr[ju]
+        # keep the per-pair differences around for the bias panels below
+        pairs = {(i, j): diffs[k] for k, (i, j) in enumerate(zip(iu, ju))}
+        sample = np.abs(diffs).compressed()
+    bias = _percentile(sample, 98)
+
+    # find limits of the mean from the same stacked array, one compress and
+    # one percentile call instead of growing hstacks per source
+    limits = _percentile(arr.compressed(), [2, 98])
+
+    # one norm per colorbar, shared by every panel instead of a fresh
+    # Normalize built inside each pcolormesh call
+    mean_norm = Normalize(vmin=limits[0], vmax=limits[1])
+    bias_norm = Normalize(vmin=-bias, vmax=bias)
 
     # plots
     f = 1.5
-    fig = plt.figure(figsize=(f * 4 * n, (f + 0.5 * (n == 2)) * 2.2 * n), dpi=200)
+    # an explicit Figure + Agg canvas keeps the large canvas out of pyplot's
+    # global figure registry, so batch runs do not accumulate state
+    fig = Figure(figsize=(f * 4 * n, (f + 0.5 * (n == 2)) * 2.2 * n), dpi=200)
+    FigureCanvasAgg(fig)
+    # one gridspec shared by all panels rather than re-deriving it inside
+    # every add_subplot call
+    gs = fig.add_gridspec(n, n)
     mean_ax = None
     bias_ax = None
     for i in range(n):
         for j in range(n):
             if i == j:
-                a = data[sources[i]]
-                lat = np.hstack([a.lat_bnds[:, 0], a.lat_bnds[-1, -1]])
-                lon = np.hstack([a.lon_bnds[:, 0], a.lon_bnds[-1, -1]])
-                ax = fig.add_subplot(n, n, n * i + j + 1, projection=ccrs.Robinson())
+                a = arrs[i]
+                ax = fig.add_subplot(gs[i, j], projection=ccrs.Robinson())
                 if i == 0:
                     mean_ax = ax
+                # shading='auto' accepts the cell centers directly so the
+                # bounds arrays never need assembling
                 mean_plot = ax.pcolormesh(
-                    lon,
-                    lat,
+                    a.lon,
+                    a.lat,
                     a.data,
+                    shading="auto",
                     cmap=mean_cmap,
-                    vmin=limits[0],
-                    vmax=limits[1],
+                    norm=mean_norm,
                     transform=ccrs.PlateCarree(),
                 )
                 ax.set_title(sources[i])
-                ax.add_feature(
-                    cfeature.NaturalEarthFeature(
-                        "physical", "land", "110m", edgecolor="face", facecolor="0.875"
-                    ),
-                    zorder=-1,
-                )
-                ax.add_feature(
-                    cfeature.NaturalEarthFeature(
-                        "physical", "ocean", "110m", edgecolor="face", facecolor="0.750"
-                    ),
-                    zorder=-1,
-                )
+                ax.add_feature(_LAND_110M, zorder=-1)
+                ax.add_feature(_OCEAN_110M, zorder=-1)
             else:
-                a = data[sources[i]]
-                b = data[sources[j]]
+                a = arrs[i]
+                b = arrs[j]
                 if i < j:
-                    ax = fig.add_subplot(
-                        n, n, n * i + j + 1, projection=ccrs.Robinson()
-                    )
+                    ax = fig.add_subplot(gs[i, j], projection=ccrs.Robinson())
                     if i == 0 and j == (n - 1):
                         bias_ax = ax
+                    # under the numba path the dense differences were never
+                    # materialized, so build this pair's on demand
+                    if (i, j) not in pairs:
+                        pairs[(i, j)] = arr[i] - arr[j]
                     bias_plot = ax.pcolormesh(
-                        lon,
-                        lat,
-                        a.data - b.data,
-                        vmin=-bias,
-                        vmax=+bias,
+                        a.lon,
+                        a.lat,
+                        pairs[(i, j)],
+                        shading="auto",
+                        norm=bias_norm,
                         cmap=bias_cmap,
                         transform=ccrs.PlateCarree(),
                     )
                     ax.set_title(sources[i])
-                    ax.add_feature(
-                        cfeature.NaturalEarthFeature(
-                            "physical",
-                            "land",
-                            "110m",
-                            edgecolor="face",
-                            facecolor="0.875",
-                        ),
-                        zorder=-1,
-                    )
-                    ax.add_feature(
-                        cfeature.NaturalEarthFeature(
-                            "physical",
-                            "ocean",
-                            "110m",
-                            edgecolor="face",
-                            facecolor="0.750",
-                        ),
-                        zorder=-1,
-                    )
+                    ax.add_feature(_LAND_110M, zorder=-1)
+                    ax.add_feature(_OCEAN_110M, zorder=-1)
                     ax.set_title("%s - %s" % (sources[i], sources[j]))
                 else:
-                    ax = fig.add_subplot(n, n, n * i + j + 1)
-                    mask = a.data.mask + b.data.mask
-                    x = np.ma.masked_array(a.data, mask=mask).compressed()
-                    y = np.ma.masked_array(b.data, mask=mask).compressed()
+                    ax = fig.add_subplot(gs[i, j])
+                    if isinstance(a.data, np.ma.MaskedArray) or isinstance(
+                        b.data, np.ma.MaskedArray
+                    ):
+                        # a single boolean gather, no masked-array machinery
+                        good = ~(
+                            np.ma.getmaskarray(a.data) | np.ma.getmaskarray(b.data)
+                        )
+                        x = np.asarray(a.data)[good]
+                        y = np.asarray(b.data)[good]
+                    else:
+                        x = a.data.ravel()
+                        y = b.data.ravel()
+                    # at this size/alpha the scatter is visually saturated well
+                    # below the full grid, so plot a fixed-seed random sketch
+                    if x.size > 50000:
+                        rng = np.random.default_rng(0)
+                        keep = rng.choice(x.size, 50000, replace=False)
+                        x = x[keep]
+                        y = y[keep]
                     ax.plot([limits[0], limits[1]], [limits[0], limits[1]], "--r")
-                    ax.scatter(x, y, color="k", s=0.6, alpha=0.1, linewidths=0)
+                    # rasterized points keep the saved figure from carrying a
+                    # vector primitive per grid cell
+                    ax.scatter(
+                        x, y, color="k", s=0.6, alpha=0.1, linewidths=0, rasterized=True
+                    )
                     ax.set_xlim(limits[0], limits[1])
                     ax.set_ylim(limits[0], limits[1])
                     ax.set_xlabel(sources[i])
@@ -169,7 +236,6 @@ def CreateVariableComparisonArray(data, cmap, name, filename, ncolors=7):
     )
 
     fig.savefig(filename)
-    plt.close()
 
 
 if __name__ == "__main__":